@@ -2,11 +2,21 @@ import os
 import logging
 import sqlite3
 import re
-from datetime import datetime, timedelta
-from typing import List, Tuple, Optional, Dict, Any
+import time
+import threading
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from itertools import islice
+from typing import List, Tuple, Optional, Dict, Any, Callable, Iterable, Iterator
 from threading import Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from flask import Flask, request
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.error import BadRequest, RetryAfter, TelegramError, Unauthorized
 from telegram.ext import (
     Updater, CommandHandler, CallbackQueryHandler, MessageHandler,
     Filters, CallbackContext
@@ -25,6 +35,15 @@ if not ADMIN_ID_STR:
 ADMIN_ID = int(ADMIN_ID_STR)
 PORT = int(os.getenv('PORT', 5000))
 DATABASE_PATH = '/tmp/bot_database.db'
+MEMBERSHIP_CACHE_TTL = 300  # seconds a confirmed channel membership is trusted
+MEMBERSHIP_CACHE_SIZE = 10000
+BULK_SEND_RATE = 25  # messages per second, below Telegram's ~30/s bot-wide limit
+ACCESS_DENIED_CACHE_TIME = 60  # seconds clients may reuse a denied admin button's answer
+LEFT_CHANNEL_CHECK_INTERVAL = 600  # seconds between background sweeps for users who left
+LEFT_CHANNEL_CHECK_RATE = 10  # getChatMember calls per second during that sweep
+DISPATCHER_WORKERS = 32
+SEND_WORKERS = 8
+MEMBERSHIP_WORKERS = 8
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -32,28 +51,110 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Flask serves the webhook under Gunicorn; in polling mode only the health
+# endpoints are needed, so those run on a small stdlib server instead
+HEALTH_RESPONSES = {'/': b"Bot is running!", '/health': b"OK"}
+
 app = Flask(__name__)
 
 @app.route('/')
 def home():
-    return "Bot is running!"
+    return HEALTH_RESPONSES['/']
 
 @app.route('/health')
 def health():
-    return "OK"
+    return HEALTH_RESPONSES['/health']
+
+class HealthCheckHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._respond(include_body=True)
+
+    def do_HEAD(self):
+        self._respond(include_body=False)
+
+    def _respond(self, include_body: bool):
+        body = HEALTH_RESPONSES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if include_body:
+            self.wfile.write(body)
 
-def run_flask():
-    app.run(host='0.0.0.0', port=PORT)
+    def log_message(self, format, *args):
+        pass  # Keep health probes out of the bot log
+
+def run_health_server():
+    server = ThreadingHTTPServer(('0.0.0.0', PORT), HealthCheckHandler)
+    server.daemon_threads = True
+    server.serve_forever()
 
 class DatabaseManager:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self._local = threading.local()
+        # One in-process writer at a time: threads queue on this lock instead of
+        # spinning in SQLite's busy handler and risking "database is locked"
+        self._write_lock = threading.RLock()
+        # Owning thread -> connection, so connections of exited threads can be closed
+        self._connections: Dict[threading.Thread, sqlite3.Connection] = {}
+        self._connections_lock = threading.Lock()
         self.init_database()
 
+    def _conn(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit mode: plain statements commit on their own and
+            # multi-statement writes go through transaction()
+            # All SQL in this module is constant text with ? placeholders, so a
+            # statement cache large enough for every query skips re-preparing them
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                                   cached_statements=256)
+            # Per-connection tuning; journal_mode is persisted by init_database
+            conn.executescript('''
+                PRAGMA synchronous = NORMAL;
+                PRAGMA temp_store = MEMORY;
+                PRAGMA mmap_size = 268435456;
+                PRAGMA cache_size = -20000;
+            ''')
+            self._local.conn = conn
+            with self._connections_lock:
+                dead = [thread for thread in self._connections if not thread.is_alive()]
+                for thread in dead:
+                    self._close_connection(self._connections.pop(thread))
+                self._connections[threading.current_thread()] = conn
+        return conn
+
+    @staticmethod
+    def _close_connection(conn: sqlite3.Connection) -> None:
+        try:
+            # Refreshes planner statistics for tables whose queries would benefit
+            conn.execute("PRAGMA optimize")
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        """Close every thread's connection; registered with atexit"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, {}
+        for conn in connections.values():
+            self._close_connection(conn)
+
     def init_database(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._conn()
         cursor = conn.cursor()
         
+        # WAL lets readers run alongside the writer; the setting sticks to the file.
+        # SQLite answers with the mode actually in effect rather than failing
+        journal_mode = cursor.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if journal_mode.lower() != 'wal':
+            logger.warning("SQLite refused WAL, running with journal_mode=%s", journal_mode)
+        
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS channels (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -67,7 +168,7 @@ class DatabaseManager:
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
                 verified BOOLEAN DEFAULT FALSE,
-                last_key_time TIMESTAMP,
+                last_key_time INTEGER,
                 total_keys_claimed INTEGER DEFAULT 0,
                 first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 blocked BOOLEAN DEFAULT FALSE,
@@ -95,8 +196,8 @@ class DatabaseManager:
                 username TEXT,
                 key_id INTEGER NOT NULL,
                 key_text TEXT NOT NULL,
-                assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP,
+                assigned_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                expires_at INTEGER,
                 active BOOLEAN DEFAULT TRUE,
                 left_channel BOOLEAN DEFAULT FALSE,
                 FOREIGN KEY (key_id) REFERENCES keys (id)
@@ -121,6 +222,48 @@ class DatabaseManager:
             )
         ''')
         
+        # last_key_time used to be stored as a local-time ISO string, convert
+        # any such rows to unix seconds
+        cursor.execute('''
+            UPDATE users SET last_key_time = CAST(strftime('%s', last_key_time, 'utc') AS INTEGER)
+            WHERE typeof(last_key_time) = 'text'
+        ''')
+        # Same conversion for sales timestamps
+        cursor.execute('''
+            UPDATE sales SET
+                assigned_at = CAST(strftime('%s', assigned_at, 'utc') AS INTEGER),
+                expires_at = CAST(strftime('%s', expires_at, 'utc') AS INTEGER)
+            WHERE typeof(assigned_at) = 'text'
+        ''')
+        # Channel usernames are stored bare and lowercase (normalize_channel_username).
+        # Legacy spellings of the same channel collapse to one row, preferring one
+        # that is already normalized, so the rename below cannot collide
+        cursor.execute('''
+            DELETE FROM channels WHERE id NOT IN (
+                SELECT COALESCE(MIN(CASE WHEN username = lower(ltrim(username, '@')) THEN id END), MIN(id))
+                FROM channels
+                GROUP BY lower(ltrim(username, '@'))
+            )
+        ''')
+        cursor.execute("UPDATE channels SET username = lower(ltrim(username, '@')) WHERE username != lower(ltrim(username, '@'))")
+
+        # Serves claim_next_key's "oldest unused key" lookup
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_keys_available ON keys (added_at) WHERE used = FALSE")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_user ON sales (user_id)")
+        # Superseded by idx_sales_left, the only ORDER BY assigned_at is on left_channel rows
+        cursor.execute("DROP INDEX IF EXISTS idx_sales_assigned")
+        # check_users_left_channels, the users-who-left screen, the verified-users
+        # counter and the FIFO waitlist
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_active_left ON sales (active, left_channel)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_left ON sales (left_channel, assigned_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_verified ON users (verified)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_waitlist_added ON waitlist (added_at)")
+        # One waitlist entry per user; drop any duplicates left from before the index
+        cursor.execute("DELETE FROM waitlist WHERE id NOT IN (SELECT MIN(id) FROM waitlist GROUP BY user_id)")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_waitlist_user ON waitlist (user_id)")
+        # Newest-first paging in the all-users screen
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_first_seen ON users (first_seen)")
+        
         cursor.execute('''
             INSERT OR IGNORE INTO settings (key, value) VALUES 
             ('cooldown_hours', '24'),
@@ -128,18 +271,41 @@ class DatabaseManager:
             ('awaiting_admin_action', '')
         ''')
         
-        conn.commit()
-        conn.close()
         logger.info("Database initialized successfully")
 
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run the enclosed statements as a single transaction"""
+        conn = self._conn()
+        with self._write_lock:
+            # IMMEDIATE takes the write lock up front instead of on the first write
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def execute(self, query: str, params: tuple = ()) -> sqlite3.Cursor:
+        conn = self._conn()
+        if query.lstrip()[:6].upper() == "SELECT":
+            return conn.execute(query, params)
+        with self._write_lock:
+            return conn.execute(query, params)
+
+    def executemany(self, query: str, seq_of_params: Iterable[tuple]) -> int:
+        """Run query for every params tuple in one transaction, returns rows changed"""
+        with self.transaction() as conn:
+            return conn.executemany(query, seq_of_params).rowcount
+
     def execute_query(self, query: str, params: tuple = ()):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        conn.commit()
-        result = cursor.fetchall()
-        conn.close()
-        return result
+        if query.lstrip()[:6].upper() == "SELECT":
+            return self.execute(query, params).fetchall()
+        # A write with RETURNING is only finished, and its implicit transaction
+        # committed, once every row is stepped, so fetch under the write lock
+        with self._write_lock:
+            return self.execute(query, params).fetchall()
 
     def fetch_one(self, query: str, params: tuple = ()) -> Optional[Tuple]:
         result = self.execute_query(query, params)
@@ -149,6 +315,7 @@ class DatabaseManager:
         return self.execute_query(query, params)
 
 db = DatabaseManager(DATABASE_PATH)
+atexit.register(db.close)
 
 # User state management
 user_states = {}
@@ -164,10 +331,12 @@ def clear_user_state(user_id: int):
         del user_states[user_id]
 
 # Utility functions
+DEFAULT_BLOCK_REASON = "You have been blocked by admin."
+
 def is_user_blocked(user_id: int) -> Tuple[bool, str]:
     result = db.fetch_one("SELECT blocked, block_reason FROM users WHERE user_id = ?", (user_id,))
     if result and result[0]:
-        return True, result[1] or "You have been blocked by admin."
+        return True, result[1] or DEFAULT_BLOCK_REASON
     return False, ""
 
 def get_user_data(user_id: int) -> Dict[str, Any]:
@@ -189,69 +358,262 @@ def get_user_data(user_id: int) -> Dict[str, Any]:
     return {}
 
 def update_user(user_id: int, username: str = None):
-    user = get_user_data(user_id)
-    if user:
-        if username and username != user['username']:
-            db.execute_query("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
-    else:
-        db.execute_query(
-            "INSERT INTO users (user_id, username, verified, blocked) VALUES (?, ?, FALSE, FALSE)",
-            (user_id, username)
-        )
+    # Single UPSERT: registers new users, refreshes a changed username otherwise
+    db.execute_query('''
+        INSERT INTO users (user_id, username, verified, blocked) VALUES (?, ?, FALSE, FALSE)
+        ON CONFLICT(user_id) DO UPDATE SET username = excluded.username
+        WHERE excluded.username IS NOT NULL AND excluded.username != ''
+            AND users.username IS NOT excluded.username
+    ''', (user_id, username))
+
+# Channels and settings only change through the admin panel, so they are
+# cached in-process and invalidated by the admin handlers that write them
+_cache_lock = threading.Lock()
+_channels_cache: Optional[List[Tuple[str, str]]] = None
+_settings_cache: Dict[str, Optional[str]] = {}
+
+def invalidate_channels_cache() -> None:
+    global _channels_cache
+    with _cache_lock:
+        _channels_cache = None
+
+def normalize_channel_username(text: str) -> str:
+    """Store channels as bare lowercase usernames; Telegram usernames ignore case"""
+    return text.strip().lstrip('@').lower()
 
 def get_verification_channels() -> List[Tuple[str, str]]:
-    results = db.fetch_all("SELECT username, channel_link FROM channels")
-    return [(row[0], row[1] or f"@{row[0]}") for row in results]
+    global _channels_cache
+    # Reading the reference is atomic, so hits skip the lock entirely
+    channels = _channels_cache
+    if channels is not None:
+        return channels
+    with _cache_lock:
+        if _channels_cache is None:
+            results = db.fetch_all("SELECT username, channel_link FROM channels")
+            _channels_cache = [(row[0], row[1] or f"@{row[0]}") for row in results]
+        return _channels_cache
+
+def get_setting(key: str) -> Optional[str]:
+    try:
+        return _settings_cache[key]
+    except KeyError:
+        pass
+    with _cache_lock:
+        if key not in _settings_cache:
+            # The table is a handful of rows, so the first miss loads all of them
+            for row_key, value in db.fetch_all("SELECT key, value FROM settings"):
+                _settings_cache.setdefault(row_key, value)
+            _settings_cache.setdefault(key, None)
+        return _settings_cache[key]
+
+def set_setting(key: str, value: str) -> None:
+    """Persist a setting and update the cached copy in place (write-through)"""
+    db.execute(
+        "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value)
+    )
+    with _cache_lock:
+        _settings_cache[key] = value
+
+# Confirmed memberships, (user_id, channel) -> time checked, in LRU order.
+# Only positive results are cached so a user who just joined is re-checked.
+_membership_cache: 'OrderedDict[Tuple[int, str], float]' = OrderedDict()
+_membership_lock = threading.Lock()
+
+def is_cached_member(user_id: int, channel_username: str) -> bool:
+    """True if the user's membership in the channel was confirmed within the TTL"""
+    cache_key = (user_id, channel_username)
+    with _membership_lock:
+        checked_at = _membership_cache.get(cache_key)
+        if checked_at is not None and time.monotonic() - checked_at < MEMBERSHIP_CACHE_TTL:
+            _membership_cache.move_to_end(cache_key)
+            return True
+    return False
 
-def check_channel_membership(bot, user_id: int, channel_username: str) -> bool:
+def lookup_channel_membership(bot, user_id: int, channel_username: str) -> Optional[bool]:
+    """Ask Telegram whether the user is in the channel, None if the API call failed"""
+    cache_key = (user_id, channel_username)
+    now = time.monotonic()
     try:
-        if channel_username.startswith('@'):
-            channel_username = channel_username[1:]
         chat_member = bot.get_chat_member(chat_id=f"@{channel_username}", user_id=user_id)
-        return chat_member.status in ['member', 'administrator', 'creator']
+        is_member = chat_member.status in ['member', 'administrator', 'creator']
     except Exception as e:
-        logger.error(f"Error checking membership for {channel_username}: {e}")
-        return False
+        logger.error("Error checking membership for %s: %s", channel_username, e)
+        return None
+    
+    with _membership_lock:
+        if is_member:
+            _membership_cache[cache_key] = now
+            _membership_cache.move_to_end(cache_key)
+            if len(_membership_cache) > MEMBERSHIP_CACHE_SIZE:
+                _membership_cache.popitem(last=False)
+        else:
+            _membership_cache.pop(cache_key, None)
+    return is_member
+
+def check_channel_membership(bot, user_id: int, channel_username: str) -> bool:
+    """channel_username comes from the channels table, already normalized"""
+    if is_cached_member(user_id, channel_username):
+        return True
+    # A failed lookup counts as not joined here; the user can press verify again
+    return lookup_channel_membership(bot, user_id, channel_username) is True
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across all threads"""
+
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+# Bulk sends (waitlist keys, announcements) overlap their round trips on a small
+# pool while the shared limiter keeps them under Telegram's per-bot message rate
+send_limiter = RateLimiter(BULK_SEND_RATE)
+_send_executor = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix='sender')
+
+def broadcast(send: Callable[[int], Any], user_ids: Iterable[int]) -> Tuple[int, int]:
+    """Call send(user_id) for every user through the send pool, returns (sent, failed)"""
+    unreachable: List[int] = []
+    
+    def send_one(user_id: int) -> bool:
+        send_limiter.wait()
+        try:
+            try:
+                send(user_id)
+            except RetryAfter as e:
+                # Flood control slipped past the limiter: wait out the server's
+                # hint once instead of dropping this recipient
+                time.sleep(e.retry_after)
+                send(user_id)
+            return True
+        except (Unauthorized, BadRequest):
+            # Bot blocked by the user or chat gone; list.append is thread-safe
+            unreachable.append(user_id)
+            return False
+        except TelegramError:
+            return False
+    
+    results = list(_send_executor.map(send_one, user_ids))
+    sent = sum(results)
+    failed = len(results) - sent
+    if failed:
+        logger.info("Broadcast: %d sent, %d failed (%d unreachable)", sent, failed, len(unreachable))
+    return sent, failed
+
+# Long-lived pool so verifying N channels costs one round trip, not N
+_membership_executor = ThreadPoolExecutor(max_workers=MEMBERSHIP_WORKERS, thread_name_prefix='membership')
 
 def verify_all_channels(bot, user_id: int) -> bool:
     channels = get_verification_channels()
     if not channels:
         return True
-    for channel, _ in channels:
-        if not check_channel_membership(bot, user_id, channel):
+    # Cached members are answered inline; only the misses cost an API call
+    misses = [channel for channel, _ in channels if not is_cached_member(user_id, channel)]
+    if not misses:
+        return True
+    if len(misses) == 1:
+        return check_channel_membership(bot, user_id, misses[0])
+    
+    futures = [
+        _membership_executor.submit(check_channel_membership, bot, user_id, channel)
+        for channel in misses
+    ]
+    # Stop at the first channel the user is missing from, whichever answers first
+    for future in as_completed(futures):
+        if not future.result():
+            for pending in futures:
+                pending.cancel()
             return False
     return True
 
+# The sweep checks every user with an active sale, so its getChatMember calls
+# are paced instead of bursting at the API
+sweep_limiter = RateLimiter(LEFT_CHANNEL_CHECK_RATE)
+
 def check_users_left_channels(bot):
-    """Check if users who claimed keys left channels"""
-    active_sales = db.fetch_all('''
-        SELECT DISTINCT s.user_id, s.id 
-        FROM sales s 
-        WHERE s.active = TRUE AND s.left_channel = FALSE
+    """Flag the active sales of users who are no longer in every channel
+
+    Only a definite "not a member" answer flags a user; left_channel is never
+    cleared, so a failed API call leaves the user for the next sweep instead.
+    """
+    channels = get_verification_channels()
+    if not channels:
+        return
+    
+    active_users = db.fetch_all('''
+        SELECT user_id, GROUP_CONCAT(id)
+        FROM sales
+        WHERE active = TRUE AND left_channel = FALSE
+        GROUP BY user_id
     ''')
     
-    for user_id, sale_id in active_sales:
-        if not verify_all_channels(bot, user_id):
-            db.execute_query("UPDATE sales SET left_channel = TRUE WHERE id = ?", (sale_id,))
+    left = []
+    for user_id, sale_ids in active_users:
+        for channel, _ in channels:
+            if is_cached_member(user_id, channel):
+                continue
+            sweep_limiter.wait()
+            if lookup_channel_membership(bot, user_id, channel) is False:
+                left.extend((int(sale_id),) for sale_id in sale_ids.split(','))
+                break
+    
+    if left:
+        db.executemany("UPDATE sales SET left_channel = TRUE WHERE id = ?", left)
 
-def get_available_key():
-    result = db.fetch_one(
-        "SELECT id, key_text, duration_value, duration_unit, meta_name, meta_link FROM keys WHERE used = FALSE ORDER BY added_at ASC LIMIT 1"
-    )
-    return result
+def left_channels_job(context: CallbackContext) -> None:
+    """JobQueue entry point for the periodic users-who-left sweep"""
+    check_users_left_channels(context.bot)
+
+# Number followed by an optional unit word; only the unit's first letter matters
+DURATION_PATTERN = re.compile(r'^\s*(\d+)\s*([hd][a-z]*)?\s*$', re.IGNORECASE)
 
 def parse_duration(duration_str: str) -> Tuple[int, str]:
-    """Parse duration string like '24h', '7d', '30days', '12hours'"""
-    duration_str = duration_str.strip().lower()
-    
-    if duration_str.endswith('h') or 'hour' in duration_str:
-        value = int(re.sub(r'[^\d]', '', duration_str))
-        return value, 'hours'
-    elif duration_str.endswith('d') or 'day' in duration_str:
-        value = int(re.sub(r'[^\d]', '', duration_str))
-        return value, 'days'
+    """Parse duration string like '24h', '7d', '30days', '12hours'; a bare number means days"""
+    match = DURATION_PATTERN.match(duration_str)
+    if not match:
+        raise ValueError(f"Invalid duration: {duration_str!r}")
+    
+    unit = match.group(2)
+    return int(match.group(1)), 'hours' if unit and unit[0] in 'hH' else 'days'
+
+def parse_key_line(line: str) -> Optional[Tuple[str, int, str, str, str]]:
+    """Parse one admin key line, None if it is blank or malformed
+
+    Accepts 'key | duration | app_name' and 'key | app_name | duration | link'.
+    """
+    # At most four fields, so a '|' inside the link stays part of the link
+    parts = line.split('|', 3)
+    if len(parts) == 3:
+        key_text, duration_str, meta_name = parts
+        meta_link = ""
+    elif len(parts) == 4:
+        key_text, meta_name, duration_str, meta_link = parts
     else:
-        return int(duration_str), 'days'
+        return None
+    
+    key_text = key_text.strip()
+    if not key_text:
+        return None
+    try:
+        duration_value, duration_unit = parse_duration(duration_str)
+    except ValueError:
+        return None
+    return key_text, duration_value, duration_unit, meta_name.strip(), meta_link.strip()
+
+def iter_key_rows(lines: Iterable[str]) -> Iterator[Tuple[str, int, str, str, str]]:
+    """Yield (key_text, duration_value, duration_unit, meta_name, meta_link) from admin key lines
+
+    Blank and malformed lines are skipped, so one bad line no longer aborts the batch.
+    """
+    return filter(None, map(parse_key_line, lines))
 
 def get_duration_in_hours(duration_value: int, duration_unit: str) -> int:
     """Convert duration to hours"""
@@ -261,97 +623,129 @@ def get_duration_in_hours(duration_value: int, duration_unit: str) -> int:
 
 def format_duration(duration_value: int, duration_unit: str) -> str:
     """Format duration for display"""
-    if duration_unit == 'hours':
-        if duration_value >= 24:
-            days = duration_value // 24
-            hours = duration_value % 24
-            if hours > 0:
-                return f"{days} days {hours} hours"
-            return f"{days} days"
+    if duration_unit != 'hours':
+        return f"{duration_value} days"
+    if duration_value < 24:
         return f"{duration_value} hours"
-    return f"{duration_value} days"
-
-def assign_key_to_user(user_id: int, username: str, key_data: Tuple) -> Dict[str, Any]:
-    key_id, key_text, duration_value, duration_unit, meta_name, meta_link = key_data
-    assigned_at = datetime.now()
-    
-    hours = get_duration_in_hours(duration_value, duration_unit)
-    expires_at = assigned_at + timedelta(hours=hours)
-    
-    db.execute_query("UPDATE keys SET used = TRUE WHERE id = ?", (key_id,))
-    db.execute_query(
-        "UPDATE users SET verified = TRUE, last_key_time = ?, total_keys_claimed = total_keys_claimed + 1 WHERE user_id = ?",
-        (assigned_at, user_id)
-    )
-    db.execute_query('''
-        INSERT INTO sales (user_id, username, key_id, key_text, assigned_at, expires_at, active)
-        VALUES (?, ?, ?, ?, ?, ?, TRUE)
-    ''', (user_id, username, key_id, key_text, assigned_at, expires_at))
+    days, hours = divmod(duration_value, 24)
+    return f"{days} days {hours} hours" if hours else f"{days} days"
+
+class CooldownActive(Exception):
+    """The user claimed a key after the caller's cooldown check (see claim_next_key)"""
+
+def claim_next_key(user_id: int, username: str, cooldown_hours: int) -> Optional[Dict[str, Any]]:
+    """Atomically take the oldest unused key for the user, None if no keys are left
+
+    The key, the user's cooldown, the sale and the waitlist removal are all
+    written in one transaction, so a claim costs a single commit. The cooldown
+    is checked again inside it and CooldownActive is raised if it is still
+    running: a button press and a waitlist pass can race for the same user.
+    """
+    now = int(time.time())
+    
+    with db.transaction() as conn:
+        # Picking and marking the key in one statement means two concurrent
+        # claims can never be handed the same key
+        key_data = conn.execute('''
+            UPDATE keys SET used = TRUE
+            WHERE id = (SELECT id FROM keys WHERE used = FALSE ORDER BY added_at ASC LIMIT 1)
+            RETURNING id, key_text, duration_value, duration_unit, meta_name, meta_link
+        ''').fetchone()
+        if not key_data:
+            return None
+        
+        key_id, key_text, duration_value, duration_unit, meta_name, meta_link = key_data
+        expires_at = now + get_duration_in_hours(duration_value, duration_unit) * 3600
+        
+        claimed = conn.execute('''
+            UPDATE users SET verified = TRUE, last_key_time = ?, total_keys_claimed = total_keys_claimed + 1
+            WHERE user_id = ? AND (last_key_time IS NULL OR last_key_time <= ?)
+        ''', (now, user_id, now - cooldown_hours * 3600)).rowcount
+        if not claimed:
+            raise CooldownActive(user_id)  # rolls back, so the key stays unused
+        conn.execute('''
+            INSERT INTO sales (user_id, username, key_id, key_text, assigned_at, expires_at, active)
+            VALUES (?, ?, ?, ?, ?, ?, TRUE)
+        ''', (user_id, username, key_id, key_text, now, expires_at))
+        # A user who got a key no longer needs a waitlist slot
+        conn.execute("DELETE FROM waitlist WHERE user_id = ?", (user_id,))
     
     return {
         'key': key_text,
         'duration': format_duration(duration_value, duration_unit),
         'product': meta_name,
         'link': meta_link,
-        'expires_at': expires_at
+        'expires_at': datetime.fromtimestamp(expires_at)
     }
 
+def add_keys(rows: Iterable[Tuple[str, int, str, str, str]]) -> int:
+    """Bulk-insert key rows in one transaction, returns how many were new (duplicates are skipped)"""
+    return db.executemany('''
+        INSERT OR IGNORE INTO keys (key_text, duration_value, duration_unit, meta_name, meta_link)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+
 def get_cooldown_hours() -> int:
-    result = db.fetch_one("SELECT value FROM settings WHERE key = 'cooldown_hours'")
-    return int(result[0]) if result else 24
+    value = get_setting('cooldown_hours')
+    return int(value) if value is not None else 24
 
 def get_key_message() -> str:
-    result = db.fetch_one("SELECT value FROM settings WHERE key = 'key_message'")
-    return result[0] if result else "🎉 Your key: {key}"
-
-def can_claim_key(user_id: int) -> Tuple[bool, Optional[str], Optional[int]]:
-    user = get_user_data(user_id)
-    if not user or not user['verified']:
-        return False, "❌ You need to verify your channel membership first!", None
-    
-    if user['last_key_time']:
+    value = get_setting('key_message')
+    return value if value is not None else "🎉 Your key: {key}"
+
+def get_next_claim_time(user: Dict[str, Any], cooldown_hours: Optional[int] = None) -> int:
+    """Unix time at which the user may claim again, 0 if they never claimed"""
+    if not user.get('last_key_time'):
+        return 0
+    if cooldown_hours is None:
         cooldown_hours = get_cooldown_hours()
-        last_claim = datetime.fromisoformat(user['last_key_time'])
-        next_claim = last_claim + timedelta(hours=cooldown_hours)
-        
-        if datetime.now() < next_claim:
-            time_left = next_claim - datetime.now()
-            seconds_left = int(time_left.total_seconds())
-            hours = seconds_left // 3600
-            minutes = (seconds_left % 3600) // 60
-            return False, f"⏳ Cooldown active!\n\n⏰ Time left: {hours}h {minutes}m", seconds_left
-    
-    available_key = get_available_key()
-    if not available_key:
-        return False, "😔 Sorry, no keys available at the moment!", None
-    
-    return True, None, None
+    return user['last_key_time'] + cooldown_hours * 3600
+
+def get_bot_stats() -> Dict[str, int]:
+    """Collect all admin statistics counters in one round trip"""
+    row = db.fetch_one('''
+        SELECT
+            (SELECT COUNT(*) FROM users),
+            (SELECT COUNT(*) FROM users WHERE verified = TRUE),
+            COUNT(*),
+            COALESCE(SUM(used = TRUE), 0),
+            COALESCE(SUM(used = FALSE), 0),
+            (SELECT COUNT(*) FROM sales)
+        FROM keys
+    ''')
+    total_users, verified_users, total_keys, used_keys, available_keys, total_sales = row
+    return {
+        'total_users': total_users,
+        'verified_users': verified_users,
+        'total_keys': total_keys,
+        'used_keys': used_keys,
+        'available_keys': available_keys,
+        'total_sales': total_sales
+    }
 
 def format_countdown(seconds: int) -> str:
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    secs = seconds % 60
+    hours, remainder = divmod(seconds, 3600)
+    minutes, secs = divmod(remainder, 60)
     return f"{hours:02d}:{minutes:02d}:{secs:02d}"
 
 # Waitlist functions
 def add_to_waitlist(user_id: int, username: str = None) -> bool:
     """Add user to waitlist if not already in it. Returns True if user was added, False if already exists"""
-    existing = db.fetch_one("SELECT id FROM waitlist WHERE user_id = ?", (user_id,))
-    if not existing:
-        db.execute_query(
-            "INSERT INTO waitlist (user_id, username, notified_admin) VALUES (?, ?, FALSE)",
-            (user_id, username)
-        )
-        return True
-    return False
+    # One atomic statement: RETURNING yields a row only when the insert happened
+    inserted = db.fetch_one(
+        "INSERT INTO waitlist (user_id, username, notified_admin) VALUES (?, ?, FALSE) "
+        "ON CONFLICT(user_id) DO NOTHING RETURNING id",
+        (user_id, username)
+    )
+    return inserted is not None
 
 def remove_from_waitlist(user_id: int) -> None:
     """Remove user from waitlist"""
     db.execute_query("DELETE FROM waitlist WHERE user_id = ?", (user_id,))
 
-def get_waitlist_users() -> List[Tuple]:
-    """Get all users in waitlist"""
-    return db.fetch_all("SELECT user_id, username, added_at FROM waitlist ORDER BY added_at ASC")
+def get_waitlist_users(limit: int = -1) -> List[Tuple]:
+    """Get users in waitlist, oldest first; a negative limit returns everyone"""
+    return db.fetch_all("SELECT user_id, username, added_at FROM waitlist ORDER BY added_at ASC LIMIT ?", (limit,))
 
 def notify_admin_waitlist(bot, user_id: int, username: str = None) -> None:
     """Notify admin when user is added to waitlist"""
@@ -364,60 +758,63 @@ def notify_admin_waitlist(bot, user_id: int, username: str = None) -> None:
         message += f"💡 Add keys using /admin → Add Keys"
         bot.send_message(chat_id=ADMIN_ID, text=message)
     except Exception as e:
-        logger.error(f"Failed to notify admin about waitlist: {e}")
+        logger.error("Failed to notify admin about waitlist: %s", e)
 
 def process_waitlist(bot) -> None:
     """Process waitlist and assign keys to waiting users"""
     waitlist = get_waitlist_users()
-    assigned_count = 0
+    deliveries = []
+    # Loop invariants: one settings read and one clock read for the whole pass
+    cooldown_hours = get_cooldown_hours()
+    key_message_template = get_key_message()
+    now = time.time()
     
     for user_id, username, added_at in waitlist:
-        # Check if user is blocked
-        blocked, reason = is_user_blocked(user_id)
-        if blocked:
+        # One row lookup covers the blocked, verified and cooldown checks
+        user = get_user_data(user_id)
+        if user.get('blocked'):
             remove_from_waitlist(user_id)
             continue
         
         # Check if user can still claim (verified, not in cooldown)
-        user = get_user_data(user_id)
         if not user or not user['verified']:
             remove_from_waitlist(user_id)
             continue
         
         # Check cooldown
-        if user['last_key_time']:
-            cooldown_hours = get_cooldown_hours()
-            last_claim = datetime.fromisoformat(user['last_key_time'])
-            next_claim = last_claim + timedelta(hours=cooldown_hours)
-            if datetime.now() < next_claim:
-                continue  # Still in cooldown, skip
+        if get_next_claim_time(user, cooldown_hours) > now:
+            continue  # Still in cooldown, skip
         
         # Try to assign key
-        key_data = get_available_key()
-        if not key_data:
+        try:
+            assigned_key = claim_next_key(user_id, username, cooldown_hours)
+        except CooldownActive:
+            continue  # Claimed through the button since the check above
+        if not assigned_key:
             break  # No more keys available
-        
-        assigned_key = assign_key_to_user(user_id, username, key_data)
-        
-        # Send key to user
+        deliveries.append((user_id, assigned_key))
+    
+    def deliver(delivery: Tuple[int, Dict[str, Any]]) -> bool:
+        user_id, assigned_key = delivery
         try:
-            key_message_template = get_key_message()
             key_message = key_message_template.format(
                 key=assigned_key['key'],
                 duration=assigned_key['duration'],
                 product=assigned_key['product'],
                 link=assigned_key['link']
             )
+            send_limiter.wait()
             bot.send_message(
                 chat_id=user_id,
                 text=f"🎉 Your key is ready!\n\n{key_message}\n\n⏰ Expires: {assigned_key['expires_at'].strftime('%Y-%m-%d %H:%M')}"
             )
-            assigned_count += 1
+            return True
         except Exception as e:
-            logger.error(f"Failed to send key to user {user_id}: {e}")
-        
-        # Remove from waitlist
-        remove_from_waitlist(user_id)
+            logger.error("Failed to send key to user %s: %s", user_id, e)
+            return False
+    
+    # Keys are claimed above one by one; the messages go out in parallel
+    assigned_count = sum(_send_executor.map(deliver, deliveries))
     
     # Notify admin if keys were assigned
     if assigned_count > 0:
@@ -427,56 +824,108 @@ def process_waitlist(bot) -> None:
                 text=f"✅ Assigned {assigned_count} key(s) to waitlist users!"
             )
         except Exception as e:
-            logger.error(f"Failed to notify admin about waitlist assignment: {e}")
+            logger.error("Failed to notify admin about waitlist assignment: %s", e)
 
 # Keyboard builders
+# Static markups are built once at import; PTB serializes them per request, so
+# sharing a single instance across handlers and threads is safe.
+_CLAIM_ROW = [
+    InlineKeyboardButton("✅ Verify Membership", callback_data="verify"),
+    InlineKeyboardButton("🎁 Claim Key", callback_data="start_claim")
+]
+
+_MAIN_KB = InlineKeyboardMarkup([_CLAIM_ROW])
+
+_ADMIN_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Statistics", callback_data="admin_stats"),
+     InlineKeyboardButton("👥 All Users", callback_data="admin_all_users")],
+    [InlineKeyboardButton("🔑 Add Keys", callback_data="admin_add_keys"),
+     InlineKeyboardButton("⏳ Waitlist", callback_data="admin_waitlist")],
+    [InlineKeyboardButton("📢 Add Channel", callback_data="admin_add_channel"),
+     InlineKeyboardButton("🗑 Remove Channel", callback_data="admin_remove_channel")],
+    [InlineKeyboardButton("📋 List Channels", callback_data="admin_list_channels")],
+    [InlineKeyboardButton("⏰ Set Cooldown", callback_data="admin_set_cooldown"),
+     InlineKeyboardButton("💬 Set Key Message", callback_data="admin_set_key_msg")],
+    [InlineKeyboardButton("🔄 Reset Cooldown (User)", callback_data="admin_reset_cooldown"),
+     InlineKeyboardButton("🔄 Reset All Cooldown", callback_data="admin_reset_all_cooldown")],
+    [InlineKeyboardButton("🚫 Block User", callback_data="admin_block_user"),
+     InlineKeyboardButton("✅ Unblock User", callback_data="admin_unblock_user")],
+    [InlineKeyboardButton("📣 Send Announcement", callback_data="admin_announcement")],
+    [InlineKeyboardButton("🚪 Users Who Left", callback_data="admin_left_users"),
+     InlineKeyboardButton("❌ Delete All Keys", callback_data="admin_delete_all_keys")]
+])
+
+_BACK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_back_main")]])
+
+_ANNOUNCEMENT_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Text Only", callback_data="announce_text")],
+    [InlineKeyboardButton("🖼 With Photo", callback_data="announce_photo")],
+    [InlineKeyboardButton("🔙 Back", callback_data="admin_back_main")]
+])
+
+_CONFIRM_DELETE_KB = InlineKeyboardMarkup([[
+    InlineKeyboardButton("✅ Confirm Delete", callback_data="confirm_delete_all_keys"),
+    InlineKeyboardButton("❌ Cancel", callback_data="admin_back_main")
+]])
+
+_CONFIRM_RESET_KB = InlineKeyboardMarkup([[
+    InlineKeyboardButton("✅ Confirm Reset All", callback_data="confirm_reset_all_cooldown"),
+    InlineKeyboardButton("❌ Cancel", callback_data="admin_back_main")
+]])
+
+# (channel list, markup built from it); get_verification_channels hands out the
+# same list object until the channels change, so identity marks the revision
+_main_keyboard_cache: Tuple[Optional[List[Tuple[str, str]]], Optional[InlineKeyboardMarkup]] = (None, None)
+
 def get_main_keyboard(bot=None, user_id=None) -> InlineKeyboardMarkup:
-    keyboard = []
-    
+    global _main_keyboard_cache
     channels = get_verification_channels()
-    if channels and user_id:
-        for channel_name, channel_link in channels:
-            keyboard.append([InlineKeyboardButton(f"📢 Join @{channel_name}", url=f"https://t.me/{channel_name}")])
-    
-    keyboard.append([
-        InlineKeyboardButton("✅ Verify Membership", callback_data="verify"),
-        InlineKeyboardButton("🎁 Claim Key", callback_data="start_claim")
-    ])
+    if not (channels and user_id):
+        return _MAIN_KB
+    
+    cached_channels, markup = _main_keyboard_cache
+    if cached_channels is not channels:
+        keyboard = [
+            [InlineKeyboardButton(f"📢 Join @{channel_name}", url=f"https://t.me/{channel_name}")]
+            for channel_name, channel_link in channels
+        ]
+        keyboard.append(_CLAIM_ROW)
+        markup = InlineKeyboardMarkup(keyboard)
+        _main_keyboard_cache = (channels, markup)
     
-    return InlineKeyboardMarkup(keyboard)
+    return markup
 
 def get_admin_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton("📊 Statistics", callback_data="admin_stats"),
-         InlineKeyboardButton("👥 All Users", callback_data="admin_all_users")],
-        [InlineKeyboardButton("🔑 Add Keys", callback_data="admin_add_keys"),
-         InlineKeyboardButton("⏳ Waitlist", callback_data="admin_waitlist")],
-        [InlineKeyboardButton("📢 Add Channel", callback_data="admin_add_channel"),
-         InlineKeyboardButton("🗑 Remove Channel", callback_data="admin_remove_channel")],
-        [InlineKeyboardButton("📋 List Channels", callback_data="admin_list_channels")],
-        [InlineKeyboardButton("⏰ Set Cooldown", callback_data="admin_set_cooldown"),
-         InlineKeyboardButton("💬 Set Key Message", callback_data="admin_set_key_msg")],
-        [InlineKeyboardButton("🔄 Reset Cooldown (User)", callback_data="admin_reset_cooldown"),
-         InlineKeyboardButton("🔄 Reset All Cooldown", callback_data="admin_reset_all_cooldown")],
-        [InlineKeyboardButton("🚫 Block User", callback_data="admin_block_user"),
-         InlineKeyboardButton("✅ Unblock User", callback_data="admin_unblock_user")],
-        [InlineKeyboardButton("📣 Send Announcement", callback_data="admin_announcement")],
-        [InlineKeyboardButton("🚪 Users Who Left", callback_data="admin_left_users"),
-         InlineKeyboardButton("❌ Delete All Keys", callback_data="admin_delete_all_keys")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _ADMIN_KB
 
 def get_back_admin_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [[InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_back_main")]]
-    return InlineKeyboardMarkup(keyboard)
+    return _BACK_KB
 
 def get_announcement_type_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton("📝 Text Only", callback_data="announce_text")],
-        [InlineKeyboardButton("🖼 With Photo", callback_data="announce_photo")],
-        [InlineKeyboardButton("🔙 Back", callback_data="admin_back_main")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _ANNOUNCEMENT_KB
+
+def get_confirm_delete_keyboard() -> InlineKeyboardMarkup:
+    return _CONFIRM_DELETE_KB
+
+def get_confirm_reset_keyboard() -> InlineKeyboardMarkup:
+    return _CONFIRM_RESET_KB
+
+def edit_if_changed(query, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+    """Edit the callback's message unless it already shows this text and keyboard
+
+    Telegram rejects an identical edit with "Message is not modified" (e.g. a
+    second failed verify press); the query carries the message as the user saw
+    it, so the comparison costs no API call. Telegram trims the stored text.
+    When only the keyboard differs, just the markup is sent.
+    """
+    message = query.message
+    if message is not None and message.text == text.strip():
+        if message.reply_markup == reply_markup:
+            return
+        if reply_markup is not None:
+            query.edit_message_reply_markup(reply_markup=reply_markup)
+            return
+    query.edit_message_text(text, reply_markup=reply_markup)
 
 # User handlers
 def start(update: Update, context: CallbackContext) -> None:
@@ -516,7 +965,7 @@ def verify_callback(update: Update, context: CallbackContext) -> None:
     channels = get_verification_channels()
     if not channels:
         db.execute_query("UPDATE users SET verified = TRUE WHERE user_id = ?", (user_id,))
-        query.edit_message_text(
+        edit_if_changed(query, 
             "✅ No verification channels required. You're automatically verified!\n\nYou can now claim your key!",
             reply_markup=get_main_keyboard(context.bot, user_id)
         )
@@ -526,12 +975,12 @@ def verify_callback(update: Update, context: CallbackContext) -> None:
     
     if is_member:
         db.execute_query("UPDATE users SET verified = TRUE WHERE user_id = ?", (user_id,))
-        query.edit_message_text(
+        edit_if_changed(query, 
             "✅ Verification successful! You've joined all required channels.\n\n🎁 You can now claim your key!",
             reply_markup=get_main_keyboard(context.bot, user_id)
         )
     else:
-        query.edit_message_text(
+        edit_if_changed(query, 
             "❌ Please join all required channels using the buttons above.\n\n"
             "After joining all channels, click '✅ Verify Membership' again.",
             reply_markup=get_main_keyboard(context.bot, user_id)
@@ -543,44 +992,46 @@ def claim_callback(update: Update, context: CallbackContext) -> None:
     user_id = query.from_user.id
     username = query.from_user.username
     
-    blocked, reason = is_user_blocked(user_id)
-    if blocked:
-        query.answer(f"🚫 {reason}", show_alert=True)
+    # Load the row once for the blocked, verified and cooldown checks;
+    # update_user below only touches the username
+    user = get_user_data(user_id)
+    if user.get('blocked'):
+        query.answer(f"🚫 {user['block_reason'] or DEFAULT_BLOCK_REASON}", show_alert=True)
         return
     
     update_user(user_id, username)
     
     # Check if user is verified
-    user = get_user_data(user_id)
     if not user or not user['verified']:
         query.answer("❌ You need to verify your channel membership first!", show_alert=True)
         return
     
     # Check cooldown
-    if user['last_key_time']:
-        cooldown_hours = get_cooldown_hours()
-        last_claim = datetime.fromisoformat(user['last_key_time'])
-        next_claim = last_claim + timedelta(hours=cooldown_hours)
+    cooldown_hours = get_cooldown_hours()
+    next_claim = get_next_claim_time(user, cooldown_hours)
+    seconds_left = int(next_claim - time.time())
+    if seconds_left > 0:
+        hours, minutes = divmod(seconds_left // 60, 60)
         
-        if datetime.now() < next_claim:
-            time_left = next_claim - datetime.now()
-            seconds_left = int(time_left.total_seconds())
-            hours = seconds_left // 3600
-            minutes = (seconds_left % 3600) // 60
-            
-            cooldown_msg = f"⏰ Cooldown Active!\n\n"
-            cooldown_msg += f"🕐 Time Remaining: {hours} hours {minutes} minutes\n\n"
-            cooldown_msg += f"⏳ You can claim your next key at:\n"
-            cooldown_msg += f"📅 {next_claim.strftime('%Y-%m-%d %H:%M')}\n\n"
-            cooldown_msg += f"Please wait for the cooldown to finish!"
-            
-            # Show popup alert to preserve key message (don't edit message)
-            query.answer(cooldown_msg, show_alert=True)
-            return
+        cooldown_msg = f"⏰ Cooldown Active!\n\n"
+        cooldown_msg += f"🕐 Time Remaining: {hours} hours {minutes} minutes\n\n"
+        cooldown_msg += f"⏳ You can claim your next key at:\n"
+        cooldown_msg += f"📅 {datetime.fromtimestamp(next_claim).strftime('%Y-%m-%d %H:%M')}\n\n"
+        cooldown_msg += f"Please wait for the cooldown to finish!"
+        
+        # Show popup alert to preserve key message (don't edit message)
+        query.answer(cooldown_msg, show_alert=True)
+        return
     
-    # Check for available keys
-    key_data = get_available_key()
-    if not key_data:
+    # Assign a key, or queue the user if none are available
+    try:
+        assigned_key = claim_next_key(user_id, username, cooldown_hours)
+    except CooldownActive:
+        # Another claim for this user (a double press or a waitlist pass)
+        # landed between the check above and now
+        query.answer("⏰ You just received a key!\n\nPlease wait for the cooldown to finish!", show_alert=True)
+        return
+    if not assigned_key:
         # Add to waitlist and notify admin only if newly added
         was_added = add_to_waitlist(user_id, username)
         if was_added:
@@ -590,8 +1041,6 @@ def claim_callback(update: Update, context: CallbackContext) -> None:
             query.answer("😔 No keys available right now!\n\n⏳ You're already on the waitlist.\n📬 You'll receive your key automatically when admin adds new keys!", show_alert=True)
         return
     
-    assigned_key = assign_key_to_user(user_id, username, key_data)
-    
     key_message_template = get_key_message()
     key_message = key_message_template.format(
         key=assigned_key['key'],
@@ -610,101 +1059,96 @@ def claim_callback(update: Update, context: CallbackContext) -> None:
         query.answer("✅ Key sent!", show_alert=False)
     except:
         # Fallback to edit if send fails
-        query.edit_message_text(
+        edit_if_changed(query, 
             key_message + f"\n\n⏰ Expires: {assigned_key['expires_at'].strftime('%Y-%m-%d %H:%M')}",
             reply_markup=get_main_keyboard(context.bot, user_id)
         )
 
 # Admin handlers
+def admin_only(func):
+    """Reject non-admins before the handler answers or touches the database"""
+    @wraps(func)
+    def wrapper(update: Update, context: CallbackContext) -> None:
+        if update.effective_user.id != ADMIN_ID:
+            if update.callback_query:
+                # The denial never changes, so let the client reuse it instead of
+                # calling back into the bot on repeated presses
+                update.callback_query.answer("Access denied", show_alert=True, cache_time=ACCESS_DENIED_CACHE_TIME)
+            else:
+                update.message.reply_text("❌ Access denied.")
+            return
+        return func(update, context)
+    return wrapper
+
+@admin_only
 def admin_command(update: Update, context: CallbackContext) -> None:
-    if update.effective_user.id != ADMIN_ID:
-        update.message.reply_text("❌ Access denied.")
-        return
-    
     admin_text = "👨‍💼 Admin Panel\n\nSelect an option below:"
     update.message.reply_text(admin_text, reply_markup=get_admin_keyboard())
 
+@admin_only
 def admin_back_main_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     clear_user_state(ADMIN_ID)
     admin_text = "👨‍💼 Admin Panel\n\nSelect an option below:"
-    query.edit_message_text(admin_text, reply_markup=get_admin_keyboard())
+    edit_if_changed(query, admin_text, reply_markup=get_admin_keyboard())
 
+@admin_only
 def admin_stats_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
-    total_users_result = db.fetch_one("SELECT COUNT(*) FROM users")
-    total_users = total_users_result[0] if total_users_result else 0
-    verified_users_result = db.fetch_one("SELECT COUNT(*) FROM users WHERE verified = TRUE")
-    verified_users = verified_users_result[0] if verified_users_result else 0
-    total_keys_result = db.fetch_one("SELECT COUNT(*) FROM keys")
-    total_keys = total_keys_result[0] if total_keys_result else 0
-    used_keys_result = db.fetch_one("SELECT COUNT(*) FROM keys WHERE used = TRUE")
-    used_keys = used_keys_result[0] if used_keys_result else 0
-    available_keys_result = db.fetch_one("SELECT COUNT(*) FROM keys WHERE used = FALSE")
-    available_keys = available_keys_result[0] if available_keys_result else 0
-    total_sales_result = db.fetch_one("SELECT COUNT(*) FROM sales")
-    total_sales = total_sales_result[0] if total_sales_result else 0
+    stats = get_bot_stats()
     
     stats_text = f"""
 📊 Bot Statistics
 
 👥 Users:
-• Total Users: {total_users}
-• Verified Users: {verified_users}
+• Total Users: {stats['total_users']}
+• Verified Users: {stats['verified_users']}
 
 🔑 Keys:
-• Total Keys: {total_keys}
-• Used Keys: {used_keys}
-• Available Keys: {available_keys}
+• Total Keys: {stats['total_keys']}
+• Used Keys: {stats['used_keys']}
+• Available Keys: {stats['available_keys']}
 
-💰 Total Claims: {total_sales}
+💰 Total Claims: {stats['total_sales']}
 """
     
-    query.edit_message_text(stats_text, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, stats_text, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_all_users_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
-    # Get page number from callback data
+    # Get page number from callback data (admin_all_users_page_N)
     page = 1
     if query.data and "page_" in query.data:
-        page = int(query.data.split("_")[2])
+        page = int(query.data.rsplit("_", 1)[1])
     
     per_page = 20
-    users = db.fetch_all("SELECT user_id, username, verified, total_keys_claimed, first_seen FROM users ORDER BY first_seen DESC")
+    total_users = db.fetch_one("SELECT COUNT(*) FROM users")[0]
     
-    if not users:
-        query.edit_message_text("No users found.", reply_markup=get_back_admin_keyboard())
+    if not total_users:
+        edit_if_changed(query, "No users found.", reply_markup=get_back_admin_keyboard())
         return
     
-    total_users = len(users)
     total_pages = (total_users + per_page - 1) // per_page
-    start_idx = (page - 1) * per_page
-    end_idx = start_idx + per_page
+    page = min(max(page, 1), total_pages)
     
-    users_text = f"👥 All Users (Page {page}/{total_pages}):\n\n"
-    for user_id, username, verified, keys_claimed, first_seen in users[start_idx:end_idx]:
-        status = "✅" if verified else "❌"
-        users_text += f"{status} ID: {user_id} | @{username or 'N/A'} | Keys: {keys_claimed}\n"
+    # Only the rows for this page leave the database
+    users = db.fetch_all(
+        "SELECT user_id, username, verified, total_keys_claimed FROM users ORDER BY first_seen DESC LIMIT ? OFFSET ?",
+        (per_page, (page - 1) * per_page)
+    )
     
-    users_text += f"\n📊 Total: {total_users} user(s)"
+    user_lines = "".join(
+        f"{'✅' if verified else '❌'} ID: {user_id} | @{username or 'N/A'} | Keys: {keys_claimed}\n"
+        for user_id, username, verified, keys_claimed in users
+    )
+    users_text = f"👥 All Users (Page {page}/{total_pages}):\n\n{user_lines}\n📊 Total: {total_users} user(s)"
     
     # Add pagination buttons
     keyboard = []
@@ -717,16 +1161,13 @@ def admin_all_users_callback(update: Update, context: CallbackContext) -> None:
         keyboard.append(nav_buttons)
     keyboard.append([InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_back_main")])
     
-    query.edit_message_text(users_text, reply_markup=InlineKeyboardMarkup(keyboard))
+    edit_if_changed(query, users_text, reply_markup=InlineKeyboardMarkup(keyboard))
 
+@admin_only
 def admin_add_keys_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     instructions = """
 🔑 Add Keys
 
@@ -747,16 +1188,13 @@ You can send multiple keys (one per line).
 """
     
     set_user_state(ADMIN_ID, 'awaiting_keys')
-    query.edit_message_text(instructions, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, instructions, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_add_channel_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     instructions = """
 📢 Add Verification Channel
 
@@ -767,56 +1205,45 @@ Example: @mychannel
 """
     
     set_user_state(ADMIN_ID, 'awaiting_channel')
-    query.edit_message_text(instructions, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, instructions, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_remove_channel_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     channels = get_verification_channels()
     if not channels:
-        query.edit_message_text("No channels to remove.", reply_markup=get_back_admin_keyboard())
+        edit_if_changed(query, "No channels to remove.", reply_markup=get_back_admin_keyboard())
         return
     
-    channel_text = "Current channels:\n\n"
-    for channel, _ in channels:
-        channel_text += f"• @{channel}\n"
-    channel_text += "\nSend channel username to remove:"
+    channel_lines = "".join(f"• @{channel}\n" for channel, _ in channels)
+    channel_text = f"Current channels:\n\n{channel_lines}\nSend channel username to remove:"
     
     set_user_state(ADMIN_ID, 'awaiting_channel_remove')
-    query.edit_message_text(channel_text, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, channel_text, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_list_channels_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     channels = get_verification_channels()
     if not channels:
-        query.edit_message_text("📋 No channels configured.", reply_markup=get_back_admin_keyboard())
+        edit_if_changed(query, "📋 No channels configured.", reply_markup=get_back_admin_keyboard())
         return
     
-    channel_text = "📋 Verification Channels:\n\n"
-    for i, (channel, _) in enumerate(channels, 1):
-        channel_text += f"{i}. @{channel}\n"
+    channel_text = "📋 Verification Channels:\n\n" + "".join(
+        f"{i}. @{channel}\n" for i, (channel, _) in enumerate(channels, 1)
+    )
     
-    query.edit_message_text(channel_text, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, channel_text, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_set_cooldown_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     current_cooldown = get_cooldown_hours()
     instructions = f"""
 ⏰ Set Cooldown Period
@@ -832,16 +1259,13 @@ Examples:
 """
     
     set_user_state(ADMIN_ID, 'awaiting_cooldown')
-    query.edit_message_text(instructions, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, instructions, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_set_key_msg_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     instructions = """
 💬 Set Key Message Template
 
@@ -855,16 +1279,13 @@ Send your custom message template:
 """
     
     set_user_state(ADMIN_ID, 'awaiting_key_message')
-    query.edit_message_text(instructions, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, instructions, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_block_user_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     instructions = """
 🚫 Block User
 
@@ -876,16 +1297,13 @@ Example:
 """
     
     set_user_state(ADMIN_ID, 'awaiting_block')
-    query.edit_message_text(instructions, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, instructions, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_reset_cooldown_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     instructions = """
 🔄 Reset User Cooldown
 
@@ -898,50 +1316,35 @@ This will allow the user to claim a key immediately.
 """
     
     set_user_state(ADMIN_ID, 'awaiting_cooldown_reset')
-    query.edit_message_text(instructions, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, instructions, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_reset_all_cooldown_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Confirm Reset All", callback_data="confirm_reset_all_cooldown"),
-            InlineKeyboardButton("❌ Cancel", callback_data="admin_back_main")
-        ]
-    ]
-    query.edit_message_text(
+    edit_if_changed(query, 
         "⚠️ Are you sure you want to reset cooldown for ALL users?\n\nAll users will be able to claim keys immediately!",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=get_confirm_reset_keyboard()
     )
 
+@admin_only
 def confirm_reset_all_cooldown_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     db.execute_query("UPDATE users SET last_key_time = NULL")
     users_count = db.fetch_one("SELECT COUNT(*) FROM users")[0]
-    query.edit_message_text(
+    edit_if_changed(query, 
         f"✅ Cooldown reset for all users!\n\n📊 Total users affected: {users_count}\n\nAll users can now claim keys immediately.",
         reply_markup=get_back_admin_keyboard()
     )
 
+@admin_only
 def admin_unblock_user_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     instructions = """
 ✅ Unblock User
 
@@ -952,321 +1355,268 @@ Example:
 """
     
     set_user_state(ADMIN_ID, 'awaiting_unblock')
-    query.edit_message_text(instructions, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, instructions, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_announcement_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
-    query.edit_message_text(
+    edit_if_changed(query, 
         "📣 Send Announcement\n\nChoose announcement type:",
         reply_markup=get_announcement_type_keyboard()
     )
 
+@admin_only
 def announce_text_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     set_user_state(ADMIN_ID, 'awaiting_announcement_text')
-    query.edit_message_text(
+    edit_if_changed(query, 
         "📝 Send your announcement message (text only):",
         reply_markup=get_back_admin_keyboard()
     )
 
+@admin_only
 def announce_photo_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
     set_user_state(ADMIN_ID, 'awaiting_announcement_photo')
-    query.edit_message_text(
+    edit_if_changed(query, 
         "🖼 Send a photo with caption for announcement:",
         reply_markup=get_back_admin_keyboard()
     )
 
+@admin_only
 def admin_waitlist_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
+    total = db.fetch_one("SELECT COUNT(*) FROM waitlist")[0]
     
-    waitlist = get_waitlist_users()
-    
-    if not waitlist:
-        query.edit_message_text("✅ Waitlist is empty!", reply_markup=get_back_admin_keyboard())
+    if not total:
+        edit_if_changed(query, "✅ Waitlist is empty!", reply_markup=get_back_admin_keyboard())
         return
     
-    waitlist_text = "⏳ Users Waiting for Keys:\n\n"
-    for user_id, username, added_at in waitlist[:30]:
-        waitlist_text += f"• ID: {user_id} | @{username or 'N/A'}\n"
+    # Only the rows that are displayed are fetched
+    waitlist = get_waitlist_users(limit=30)
+    
+    parts = ["⏳ Users Waiting for Keys:\n\n"]
+    parts.extend(f"• ID: {user_id} | @{username or 'N/A'}\n" for user_id, username, added_at in waitlist)
     
-    if len(waitlist) > 30:
-        waitlist_text += f"\n... and {len(waitlist) - 30} more users"
+    if total > 30:
+        parts.append(f"\n... and {total - 30} more users")
     
-    waitlist_text += f"\n\n📊 Total: {len(waitlist)} user(s) waiting"
+    parts.append(f"\n\n📊 Total: {total} user(s) waiting")
+    waitlist_text = "".join(parts)
     
-    query.edit_message_text(waitlist_text, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, waitlist_text, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_left_users_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    query.answer("Checking users... please wait")
+    # left_channel is kept current by left_channels_job, so this only reads it
+    query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
+    total = db.fetch_one('''
+        SELECT COUNT(*) FROM (
+            SELECT DISTINCT s.user_id, s.assigned_at
+            FROM sales s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE s.left_channel = TRUE
+        )
+    ''')[0]
     
-    # Optimize: Only check active users in background
-    Thread(target=check_users_left_channels, args=(context.bot,), daemon=True).start()
+    if not total:
+        edit_if_changed(query, "✅ No users have left after claiming keys.", reply_markup=get_back_admin_keyboard())
+        return
     
+    # Only the rows that are displayed are fetched
     left_users = db.fetch_all('''
         SELECT DISTINCT u.user_id, u.username, s.assigned_at
         FROM sales s
         JOIN users u ON s.user_id = u.user_id
         WHERE s.left_channel = TRUE
         ORDER BY s.assigned_at DESC
+        LIMIT 30
     ''')
     
-    if not left_users:
-        query.edit_message_text("✅ No users have left after claiming keys.", reply_markup=get_back_admin_keyboard())
-        return
-    
-    left_text = "🚪 Users Who Left After Claiming:\n\n"
-    for user_id, username, assigned_at in left_users[:30]:
-        left_text += f"• ID: {user_id} | @{username or 'N/A'}\n"
+    parts = ["🚪 Users Who Left After Claiming:\n\n"]
+    parts.extend(f"• ID: {user_id} | @{username or 'N/A'}\n" for user_id, username, assigned_at in left_users)
     
-    if len(left_users) > 30:
-        left_text += f"\n... and {len(left_users) - 30} more users"
+    if total > 30:
+        parts.append(f"\n... and {total - 30} more users")
     
-    left_text += f"\n\n📊 Total: {len(left_users)} user(s) left"
+    parts.append(f"\n\n📊 Total: {total} user(s) left")
+    left_text = "".join(parts)
     
-    query.edit_message_text(left_text, reply_markup=get_back_admin_keyboard())
+    edit_if_changed(query, left_text, reply_markup=get_back_admin_keyboard())
 
+@admin_only
 def admin_delete_all_keys_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Confirm Delete", callback_data="confirm_delete_all_keys"),
-            InlineKeyboardButton("❌ Cancel", callback_data="admin_back_main")
-        ]
-    ]
-    query.edit_message_text(
+    edit_if_changed(query, 
         "⚠️ Are you sure you want to delete ALL keys?\n\nThis action cannot be undone!",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=get_confirm_delete_keyboard()
     )
 
+@admin_only
 def confirm_delete_all_keys_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer("Deleting all keys... please wait")
     
-    if query.from_user.id != ADMIN_ID:
-        query.answer("Access denied", show_alert=True)
-        return
-    
-    # Get count before deletion
-    count_result = db.fetch_one("SELECT COUNT(*) FROM keys")
-    total_keys = count_result[0] if count_result else 0
-    
-    # Delete in batches for better performance with large datasets
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM keys")
-    conn.commit()
-    conn.close()
-    
-    query.edit_message_text(f"✅ All {total_keys} keys deleted successfully!", reply_markup=get_back_admin_keyboard())
+    # An unqualified DELETE hits SQLite's truncate optimization (keys has no
+    # triggers and foreign_keys is off) and still reports the rows removed
+    total_keys = db.execute("DELETE FROM keys").rowcount
 
-# Process admin text input
-def process_admin_text(update: Update, context: CallbackContext) -> None:
-    if update.effective_user.id != ADMIN_ID:
-        return
+    edit_if_changed(query, f"✅ All {total_keys} keys deleted successfully!", reply_markup=get_back_admin_keyboard())
+
+# Process admin text input: one function per admin state
+def admin_text_keys(update: Update, context: CallbackContext, text: str) -> None:
+    lines = text.splitlines()
+    batch = [line for line in islice(lines, 500) if line.strip()]  # Limit to 500 keys per batch
+    rows = list(iter_key_rows(batch))
     
-    text = update.message.text.strip()
-    state = get_user_state(ADMIN_ID)
+    keys_added = add_keys(rows)
+    keys_duplicate = len(rows) - keys_added
+    keys_invalid = len(batch) - len(rows)
     
-    if state['state'] == 'awaiting_keys':
-        keys_added = 0
-        keys_duplicate = 0
-        lines = text.split('\n')
-        
-        # Support up to 500 keys per batch (increased from ~49)
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        for line in lines[:500]:  # Limit to 500 keys per batch
-            line = line.strip()
-            if not line:
-                continue
-            
-            parts = [part.strip() for part in line.split('|')]
-            if len(parts) < 2:
-                continue
-            
-            key_text = parts[0]
-            
-            if len(parts) == 3:
-                duration_value, duration_unit = parse_duration(parts[1])
-                meta_name = parts[2]
-                meta_link = ""
-            elif len(parts) >= 4:
-                meta_name = parts[1]
-                duration_value, duration_unit = parse_duration(parts[2])
-                meta_link = parts[3] if len(parts) > 3 else ""
-            else:
-                continue
-            
-            try:
-                cursor.execute('''
-                    INSERT INTO keys (key_text, duration_value, duration_unit, meta_name, meta_link)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (key_text, duration_value, duration_unit, meta_name, meta_link))
-                keys_added += 1
-            except sqlite3.IntegrityError:
-                keys_duplicate += 1
-        
-        conn.commit()
-        conn.close()
-        
-        result_text = f"✅ Added {keys_added} keys"
-        if keys_duplicate > 0:
-            result_text += f"\n❌ {keys_duplicate} duplicate keys skipped"
-        if len(lines) > 500:
-            result_text += f"\n⚠️ {len(lines) - 500} keys not processed (max 500 per batch)"
-        
-        clear_user_state(ADMIN_ID)
-        update.message.reply_text(result_text, reply_markup=get_back_admin_keyboard())
-        
-        # Process waitlist to auto-assign keys to waiting users
-        if keys_added > 0:
-            process_waitlist(context.bot)
-        
-        return
+    result_text = f"✅ Added {keys_added} keys"
+    if keys_duplicate > 0:
+        result_text += f"\n❌ {keys_duplicate} duplicate keys skipped"
+    if keys_invalid > 0:
+        result_text += f"\n⚠️ {keys_invalid} invalid lines skipped (use key | duration | app_name or key | app_name | duration | link)"
+    if len(lines) > 500:
+        result_text += f"\n⚠️ {len(lines) - 500} keys not processed (max 500 per batch)"
     
-    elif state['state'] == 'awaiting_channel':
-        channel_username = text.replace('@', '')
-        try:
-            db.execute_query("INSERT INTO channels (username) VALUES (?)", (channel_username,))
-            clear_user_state(ADMIN_ID)
-            update.message.reply_text(f"✅ Channel @{channel_username} added successfully!", reply_markup=get_back_admin_keyboard())
-        except sqlite3.IntegrityError:
-            update.message.reply_text(f"❌ Channel @{channel_username} already exists!", reply_markup=get_back_admin_keyboard())
-        return
+    clear_user_state(ADMIN_ID)
+    update.message.reply_text(result_text, reply_markup=get_back_admin_keyboard())
     
-    elif state['state'] == 'awaiting_channel_remove':
-        channel_username = text.replace('@', '')
-        db.execute_query("DELETE FROM channels WHERE username = ?", (channel_username,))
+    # Process waitlist to auto-assign keys to waiting users
+    if keys_added > 0:
+        process_waitlist(context.bot)
+
+def admin_text_add_channel(update: Update, context: CallbackContext, text: str) -> None:
+    channel_username = normalize_channel_username(text)
+    # rowcount tells a new channel from a duplicate without raising IntegrityError
+    if db.execute("INSERT OR IGNORE INTO channels (username) VALUES (?)", (channel_username,)).rowcount:
+        invalidate_channels_cache()
+        clear_user_state(ADMIN_ID)
+        update.message.reply_text(f"✅ Channel @{channel_username} added successfully!", reply_markup=get_back_admin_keyboard())
+    else:
+        update.message.reply_text(f"❌ Channel @{channel_username} already exists!", reply_markup=get_back_admin_keyboard())
+
+def admin_text_remove_channel(update: Update, context: CallbackContext, text: str) -> None:
+    channel_username = normalize_channel_username(text)
+    # The UNIQUE index on username makes this a single keyed lookup; rowcount
+    # tells us whether the channel existed without listing every channel
+    removed = db.execute("DELETE FROM channels WHERE username = ?", (channel_username,)).rowcount
+    if removed:
+        invalidate_channels_cache()
         clear_user_state(ADMIN_ID)
         update.message.reply_text(f"✅ Channel @{channel_username} removed successfully!", reply_markup=get_back_admin_keyboard())
-        return
-    
-    elif state['state'] == 'awaiting_cooldown':
-        if text.isdigit() and 1 <= int(text) <= 720:
-            db.execute_query("UPDATE settings SET value = ? WHERE key = 'cooldown_hours'", (text,))
-            clear_user_state(ADMIN_ID)
-            update.message.reply_text(f"✅ Cooldown set to {text} hours!", reply_markup=get_back_admin_keyboard())
+    else:
+        update.message.reply_text(f"❌ Channel @{channel_username} not found!", reply_markup=get_back_admin_keyboard())
+
+def admin_text_cooldown(update: Update, context: CallbackContext, text: str) -> None:
+    if text.isdigit() and 1 <= int(text) <= 720:
+        set_setting('cooldown_hours', text)
+        clear_user_state(ADMIN_ID)
+        update.message.reply_text(f"✅ Cooldown set to {text} hours!", reply_markup=get_back_admin_keyboard())
+    else:
+        update.message.reply_text("❌ Please send a number between 1 and 720.", reply_markup=get_back_admin_keyboard())
+
+def admin_text_key_message(update: Update, context: CallbackContext, text: str) -> None:
+    if '{key}' in text:
+        set_setting('key_message', text)
+        clear_user_state(ADMIN_ID)
+        update.message.reply_text("✅ Key message updated successfully!", reply_markup=get_back_admin_keyboard())
+    else:
+        update.message.reply_text("❌ Message must contain {key} placeholder.", reply_markup=get_back_admin_keyboard())
+
+def admin_text_block(update: Update, context: CallbackContext, text: str) -> None:
+    try:
+        if '|' in text:
+            parts = text.split('|')
+            user_id_str = parts[0].strip()
+            user_id_to_block = int(user_id_str)
+            reason = parts[1].strip() if len(parts) > 1 else "Blocked by admin"
+    
+            # rowcount doubles as the "user exists" check
+            if db.execute("UPDATE users SET blocked = TRUE, block_reason = ? WHERE user_id = ?", (reason, user_id_to_block)).rowcount:
+                clear_user_state(ADMIN_ID)
+                update.message.reply_text(f"✅ User {user_id_to_block} blocked!\n\nReason: {reason}", reply_markup=get_back_admin_keyboard())
+            else:
+                update.message.reply_text(f"❌ User {user_id_to_block} not found in database!", reply_markup=get_back_admin_keyboard())
         else:
-            update.message.reply_text("❌ Please send a number between 1 and 720.", reply_markup=get_back_admin_keyboard())
-        return
-    
-    elif state['state'] == 'awaiting_key_message':
-        if '{key}' in text:
-            db.execute_query("UPDATE settings SET value = ? WHERE key = 'key_message'", (text,))
+            update.message.reply_text("❌ Invalid format. Use: user_id | reason\n\nExample: 123456789 | Spam", reply_markup=get_back_admin_keyboard())
+    except ValueError:
+        update.message.reply_text("❌ Invalid user ID! Please use numeric user ID only.\n\nExample: 123456789 | reason", reply_markup=get_back_admin_keyboard())
+    except IndexError:
+        update.message.reply_text("❌ Invalid format. Use: user_id | reason", reply_markup=get_back_admin_keyboard())
+
+def admin_text_unblock(update: Update, context: CallbackContext, text: str) -> None:
+    if text.isdigit():
+        user_id_to_unblock = int(text)
+        # Only an actually blocked row is updated; the existence lookup is
+        # needed just to word the reply when nothing changed
+        if db.execute("UPDATE users SET blocked = FALSE, block_reason = '' WHERE user_id = ? AND blocked", (user_id_to_unblock,)).rowcount:
             clear_user_state(ADMIN_ID)
-            update.message.reply_text("✅ Key message updated successfully!", reply_markup=get_back_admin_keyboard())
+            update.message.reply_text(f"✅ User {user_id_to_unblock} unblocked successfully!", reply_markup=get_back_admin_keyboard())
+        elif db.fetch_one("SELECT 1 FROM users WHERE user_id = ?", (user_id_to_unblock,)):
+            clear_user_state(ADMIN_ID)
+            update.message.reply_text(f"ℹ️ User {user_id_to_unblock} is not blocked.", reply_markup=get_back_admin_keyboard())
         else:
-            update.message.reply_text("❌ Message must contain {key} placeholder.", reply_markup=get_back_admin_keyboard())
-        return
-    
-    elif state['state'] == 'awaiting_block':
-        try:
-            if '|' in text:
-                parts = text.split('|')
-                user_id_str = parts[0].strip()
-                user_id_to_block = int(user_id_str)
-                reason = parts[1].strip() if len(parts) > 1 else "Blocked by admin"
-                
-                user = get_user_data(user_id_to_block)
-                if user:
-                    db.execute_query("UPDATE users SET blocked = TRUE, block_reason = ? WHERE user_id = ?", (reason, user_id_to_block))
-                    clear_user_state(ADMIN_ID)
-                    update.message.reply_text(f"✅ User {user_id_to_block} blocked!\n\nReason: {reason}", reply_markup=get_back_admin_keyboard())
-                else:
-                    update.message.reply_text(f"❌ User {user_id_to_block} not found in database!", reply_markup=get_back_admin_keyboard())
-            else:
-                update.message.reply_text("❌ Invalid format. Use: user_id | reason\n\nExample: 123456789 | Spam", reply_markup=get_back_admin_keyboard())
-        except ValueError:
-            update.message.reply_text("❌ Invalid user ID! Please use numeric user ID only.\n\nExample: 123456789 | reason", reply_markup=get_back_admin_keyboard())
-        except IndexError:
-            update.message.reply_text("❌ Invalid format. Use: user_id | reason", reply_markup=get_back_admin_keyboard())
-        return
-    
-    elif state['state'] == 'awaiting_unblock':
-        if text.isdigit():
-            user_id_to_unblock = int(text)
-            user = get_user_data(user_id_to_unblock)
-            if user:
-                if user['blocked']:
-                    db.execute_query("UPDATE users SET blocked = FALSE, block_reason = '' WHERE user_id = ?", (user_id_to_unblock,))
-                    clear_user_state(ADMIN_ID)
-                    update.message.reply_text(f"✅ User {user_id_to_unblock} unblocked successfully!", reply_markup=get_back_admin_keyboard())
-                else:
-                    clear_user_state(ADMIN_ID)
-                    update.message.reply_text(f"ℹ️ User {user_id_to_unblock} is not blocked.", reply_markup=get_back_admin_keyboard())
-            else:
-                update.message.reply_text(f"❌ User {user_id_to_unblock} not found in database!", reply_markup=get_back_admin_keyboard())
+            update.message.reply_text(f"❌ User {user_id_to_unblock} not found in database!", reply_markup=get_back_admin_keyboard())
+    else:
+        update.message.reply_text("❌ Invalid user ID! Please send numeric user ID only.\n\nExample: 123456789", reply_markup=get_back_admin_keyboard())
+
+def admin_text_cooldown_reset(update: Update, context: CallbackContext, text: str) -> None:
+    if text.isdigit():
+        user_id_to_reset = int(text)
+        # Reset cooldown by setting last_key_time to NULL; rowcount says whether the user exists
+        if db.execute("UPDATE users SET last_key_time = NULL WHERE user_id = ?", (user_id_to_reset,)).rowcount:
+            clear_user_state(ADMIN_ID)
+            update.message.reply_text(f"✅ Cooldown reset for user {user_id_to_reset}!\n\nUser can now claim a key immediately.", reply_markup=get_back_admin_keyboard())
         else:
-            update.message.reply_text("❌ Invalid user ID! Please send numeric user ID only.\n\nExample: 123456789", reply_markup=get_back_admin_keyboard())
-        return
+            update.message.reply_text(f"❌ User {user_id_to_reset} not found in database!", reply_markup=get_back_admin_keyboard())
+    else:
+        update.message.reply_text("❌ Please send a valid user ID (numbers only).", reply_markup=get_back_admin_keyboard())
+
+def admin_text_announcement(update: Update, context: CallbackContext, text: str) -> None:
+    announcement = f"📣 Announcement:\n\n{text}"
+    sent, failed = broadcast(
+        lambda user_id: context.bot.send_message(chat_id=user_id, text=announcement),
+        (user_id for (user_id,) in db.fetch_all("SELECT user_id FROM users"))
+    )
     
-    elif state['state'] == 'awaiting_cooldown_reset':
-        if text.isdigit():
-            user_id_to_reset = int(text)
-            # Check if user exists
-            user = get_user_data(user_id_to_reset)
-            if user:
-                # Reset cooldown by setting last_key_time to NULL
-                db.execute_query("UPDATE users SET last_key_time = NULL WHERE user_id = ?", (user_id_to_reset,))
-                clear_user_state(ADMIN_ID)
-                update.message.reply_text(f"✅ Cooldown reset for user {user_id_to_reset}!\n\nUser can now claim a key immediately.", reply_markup=get_back_admin_keyboard())
-            else:
-                update.message.reply_text(f"❌ User {user_id_to_reset} not found in database!", reply_markup=get_back_admin_keyboard())
-        else:
-            update.message.reply_text("❌ Please send a valid user ID (numbers only).", reply_markup=get_back_admin_keyboard())
+    clear_user_state(ADMIN_ID)
+    update.message.reply_text(f"✅ Announcement sent to {sent} users!\n❌ Failed: {failed}", reply_markup=get_back_admin_keyboard())
+
+# Admin state -> handler for the next text message, same idea as CALLBACK_ROUTES
+ADMIN_TEXT_HANDLERS: Dict[str, Callable[[Update, CallbackContext, str], None]] = {
+    "awaiting_keys": admin_text_keys,
+    "awaiting_channel": admin_text_add_channel,
+    "awaiting_channel_remove": admin_text_remove_channel,
+    "awaiting_cooldown": admin_text_cooldown,
+    "awaiting_key_message": admin_text_key_message,
+    "awaiting_block": admin_text_block,
+    "awaiting_unblock": admin_text_unblock,
+    "awaiting_cooldown_reset": admin_text_cooldown_reset,
+    "awaiting_announcement_text": admin_text_announcement,
+}
+
+def process_admin_text(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id != ADMIN_ID:
         return
     
-    elif state['state'] == 'awaiting_announcement_text':
-        all_users = db.fetch_all("SELECT user_id FROM users")
-        sent = 0
-        failed = 0
-        
-        for (user_id,) in all_users:
-            try:
-                context.bot.send_message(chat_id=user_id, text=f"📣 Announcement:\n\n{text}")
-                sent += 1
-            except:
-                failed += 1
-        
-        clear_user_state(ADMIN_ID)
-        update.message.reply_text(f"✅ Announcement sent to {sent} users!\n❌ Failed: {failed}", reply_markup=get_back_admin_keyboard())
-        return
+    handler = ADMIN_TEXT_HANDLERS.get(get_user_state(ADMIN_ID)['state'])
+    if handler:
+        handler(update, context, update.message.text.strip())
 
 def process_admin_photo(update: Update, context: CallbackContext) -> None:
     if update.effective_user.id != ADMIN_ID:
@@ -1278,68 +1628,96 @@ def process_admin_photo(update: Update, context: CallbackContext) -> None:
         photo = update.message.photo[-1]
         caption = update.message.caption or "📣 Announcement"
         
-        all_users = db.fetch_all("SELECT user_id FROM users")
-        sent = 0
-        failed = 0
-        
-        for (user_id,) in all_users:
-            try:
-                context.bot.send_photo(chat_id=user_id, photo=photo.file_id, caption=caption)
-                sent += 1
-            except:
-                failed += 1
+        sent, failed = broadcast(
+            lambda user_id: context.bot.send_photo(chat_id=user_id, photo=photo.file_id, caption=caption),
+            (user_id for (user_id,) in db.fetch_all("SELECT user_id FROM users"))
+        )
         
         clear_user_state(ADMIN_ID)
         update.message.reply_text(f"✅ Announcement sent to {sent} users!\n❌ Failed: {failed}", reply_markup=get_back_admin_keyboard())
 
 # Main function
+# Callback routing: one handler looks up callback_data in a dict instead of
+# PTB testing ~25 regex patterns in turn for every button press
+CALLBACK_ROUTES = {
+    "verify": verify_callback,
+    "start_claim": claim_callback,
+    "admin_back_main": admin_back_main_callback,
+    "admin_stats": admin_stats_callback,
+    "admin_all_users": admin_all_users_callback,
+    "admin_add_keys": admin_add_keys_callback,
+    "admin_waitlist": admin_waitlist_callback,
+    "admin_add_channel": admin_add_channel_callback,
+    "admin_remove_channel": admin_remove_channel_callback,
+    "admin_list_channels": admin_list_channels_callback,
+    "admin_set_cooldown": admin_set_cooldown_callback,
+    "admin_set_key_msg": admin_set_key_msg_callback,
+    "admin_reset_cooldown": admin_reset_cooldown_callback,
+    "admin_reset_all_cooldown": admin_reset_all_cooldown_callback,
+    "confirm_reset_all_cooldown": confirm_reset_all_cooldown_callback,
+    "admin_block_user": admin_block_user_callback,
+    "admin_unblock_user": admin_unblock_user_callback,
+    "admin_announcement": admin_announcement_callback,
+    "announce_text": announce_text_callback,
+    "announce_photo": announce_photo_callback,
+    "admin_left_users": admin_left_users_callback,
+    "admin_delete_all_keys": admin_delete_all_keys_callback,
+    "confirm_delete_all_keys": confirm_delete_all_keys_callback,
+}
+
+# Routes that block on Telegram API calls and run on a dispatcher worker thread.
+# Concurrent claims are safe: claim_next_key re-checks the cooldown in its transaction.
+ASYNC_CALLBACKS = {verify_callback, claim_callback}
+
+def callback_router(update: Update, context: CallbackContext) -> None:
+    data = update.callback_query.data or ""
+    handler = CALLBACK_ROUTES.get(data)
+    if handler is None and data.startswith("admin_all_users_page_"):
+        handler = admin_all_users_callback
+    if handler is None:
+        logger.warning("Unhandled callback data: %s", data)
+        return
+    
+    if handler in ASYNC_CALLBACKS:
+        context.dispatcher.run_async(handler, update, context, update=update)
+    else:
+        handler(update, context)
+
 def main():
     global updater, dp
-    updater = Updater(BOT_TOKEN, use_context=True)
+    # PTB sizes the HTTP pool for its own workers only (workers + 4); the send and
+    # membership pools call the Bot API too, and urllib3 discards connections
+    # opened past the pool size instead of keeping them alive
+    updater = Updater(
+        BOT_TOKEN, use_context=True, workers=DISPATCHER_WORKERS,
+        request_kwargs={'con_pool_size': DISPATCHER_WORKERS + SEND_WORKERS + MEMBERSHIP_WORKERS + 4}
+    )
     dp = updater.dispatcher
 
-    dp.add_handler(CommandHandler("start", start))
+    dp.add_handler(CommandHandler("start", start, run_async=True))
     dp.add_handler(CommandHandler("admin", admin_command))
     
-    dp.add_handler(CallbackQueryHandler(verify_callback, pattern="^verify$"))
-    dp.add_handler(CallbackQueryHandler(claim_callback, pattern="^start_claim$"))
-    
-    dp.add_handler(CallbackQueryHandler(admin_back_main_callback, pattern="^admin_back_main$"))
-    dp.add_handler(CallbackQueryHandler(admin_stats_callback, pattern="^admin_stats$"))
-    dp.add_handler(CallbackQueryHandler(admin_all_users_callback, pattern="^admin_all_users"))
-    dp.add_handler(CallbackQueryHandler(admin_add_keys_callback, pattern="^admin_add_keys$"))
-    dp.add_handler(CallbackQueryHandler(admin_waitlist_callback, pattern="^admin_waitlist$"))
-    dp.add_handler(CallbackQueryHandler(admin_add_channel_callback, pattern="^admin_add_channel$"))
-    dp.add_handler(CallbackQueryHandler(admin_remove_channel_callback, pattern="^admin_remove_channel$"))
-    dp.add_handler(CallbackQueryHandler(admin_list_channels_callback, pattern="^admin_list_channels$"))
-    dp.add_handler(CallbackQueryHandler(admin_set_cooldown_callback, pattern="^admin_set_cooldown$"))
-    dp.add_handler(CallbackQueryHandler(admin_set_key_msg_callback, pattern="^admin_set_key_msg$"))
-    dp.add_handler(CallbackQueryHandler(admin_reset_cooldown_callback, pattern="^admin_reset_cooldown$"))
-    dp.add_handler(CallbackQueryHandler(admin_reset_all_cooldown_callback, pattern="^admin_reset_all_cooldown$"))
-    dp.add_handler(CallbackQueryHandler(confirm_reset_all_cooldown_callback, pattern="^confirm_reset_all_cooldown$"))
-    dp.add_handler(CallbackQueryHandler(admin_block_user_callback, pattern="^admin_block_user$"))
-    dp.add_handler(CallbackQueryHandler(admin_unblock_user_callback, pattern="^admin_unblock_user$"))
-    dp.add_handler(CallbackQueryHandler(admin_announcement_callback, pattern="^admin_announcement$"))
-    dp.add_handler(CallbackQueryHandler(announce_text_callback, pattern="^announce_text$"))
-    dp.add_handler(CallbackQueryHandler(announce_photo_callback, pattern="^announce_photo$"))
-    dp.add_handler(CallbackQueryHandler(admin_left_users_callback, pattern="^admin_left_users$"))
-    dp.add_handler(CallbackQueryHandler(admin_delete_all_keys_callback, pattern="^admin_delete_all_keys$"))
-    dp.add_handler(CallbackQueryHandler(confirm_delete_all_keys_callback, pattern="^confirm_delete_all_keys$"))
-    
-    dp.add_handler(MessageHandler(Filters.text & Filters.user(ADMIN_ID), process_admin_text))
-    dp.add_handler(MessageHandler(Filters.photo & Filters.user(ADMIN_ID), process_admin_photo))
+    dp.add_handler(CallbackQueryHandler(callback_router))
+    
+    dp.add_handler(MessageHandler(Filters.text & Filters.user(ADMIN_ID), process_admin_text, run_async=True))
+    dp.add_handler(MessageHandler(Filters.photo & Filters.user(ADMIN_ID), process_admin_photo, run_async=True))
+    
+    updater.job_queue.run_repeating(left_channels_job, interval=LEFT_CHANNEL_CHECK_INTERVAL, first=10)
 
     # Check if running on Render (webhook mode) or locally (polling mode)
     webhook_url = os.getenv('WEBHOOK_URL')
     
     if webhook_url:
-        # Webhook mode for Render
+        # Webhook mode for Render: the dispatcher runs in its own thread so that
+        # run_async handlers get worker threads, /webhook only enqueues updates
+        Thread(target=dp.start, name='dispatcher', daemon=True).start()
+        updater.job_queue.start()  # start_polling would do this for us
         updater.bot.set_webhook(url=f"{webhook_url}/webhook")
-        logger.info(f"Bot started in WEBHOOK mode!")
-        logger.info(f"Webhook URL: {webhook_url}/webhook")
+        logger.info("Bot started in WEBHOOK mode!")
+        logger.info("Webhook URL: %s/webhook", webhook_url)
     else:
         # Polling mode for local development (Replit)
-        Thread(target=run_flask, daemon=True).start()
+        Thread(target=run_health_server, daemon=True).start()
         logger.info("Bot started in POLLING mode!")
         updater.start_polling()
         updater.idle()
@@ -1361,10 +1739,10 @@ def webhook():
     init_bot()  # Ensure bot is initialized
     try:
         update = Update.de_json(request.get_json(force=True), updater.bot)
-        dp.process_update(update)
+        dp.update_queue.put(update)
         return 'ok', 200
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
+        logger.error("Webhook error: %s", e)
         return 'error', 500
 
 # Initialize bot when module loads (for Gunicorn)